@@ -0,0 +1,53 @@
+import torch
+
+from parameter_optimization.strotss_org import pairwise_distances_cos, distmat
+
+
+# Original STROTSS formulas the fused versions replaced
+
+def baseline_distances_cos(x, y):
+    x_norm = torch.sqrt((x ** 2).sum(1).view(-1, 1))
+    y_t = torch.transpose(y, 0, 1)
+    y_norm = torch.sqrt((y ** 2).sum(1).view(1, -1))
+    dist = 1. - torch.mm(x, y_t) / x_norm / y_norm
+    return dist
+
+
+def baseline_distances_l2(x, y):
+    x_norm = (x ** 2).sum(1).view(-1, 1)
+    y_t = torch.transpose(y, 0, 1)
+    y_norm = (y ** 2).sum(1).view(1, -1)
+    dist = x_norm + y_norm - 2.0 * torch.mm(x, y_t)
+    return torch.sqrt(torch.clamp(dist, 1e-5, 1e5) / x.size(1))
+
+
+def check_against_baseline(fn, baseline_fn):
+    torch.manual_seed(0)
+    x = torch.randn(8, 5, dtype=torch.float64, requires_grad=True)
+    y = torch.randn(8, 5, dtype=torch.float64, requires_grad=True)
+
+    # numerical vs analytical gradients of the new kernel
+    assert torch.autograd.gradcheck(fn, (x, y))
+
+    # same values and same gradients as the original formula
+    w = torch.randn(8, 8, dtype=torch.float64)
+    out, out_ref = fn(x, y), baseline_fn(x, y)
+    assert torch.allclose(out, out_ref)
+    grads = torch.autograd.grad((out * w).sum(), (x, y))
+    grads_ref = torch.autograd.grad((out_ref * w).sum(), (x, y))
+    for g, g_ref in zip(grads, grads_ref):
+        assert torch.allclose(g, g_ref)
+
+
+def test_pairwise_distances_cos():
+    check_against_baseline(pairwise_distances_cos, baseline_distances_cos)
+
+
+def test_distmat_l2():
+    check_against_baseline(lambda x, y: distmat(x, y, cos_d=False), baseline_distances_l2)
+
+
+if __name__ == '__main__':
+    test_pairwise_distances_cos()
+    test_distmat_l2()
+    print("pairwise distances match the original formulas")
@@ -19,41 +19,41 @@ from argparse import ArgumentParser
 class Vgg16_Extractor(nn.Module):
     def __init__(self, space):
         super().__init__()
-        self.vgg_layers = models.vgg16(weights='DEFAULT').features
+        vgg_layers = models.vgg16(weights='DEFAULT').features
+        self.capture_layers = [1, 3, 6, 8, 11, 13, 15, 22, 29]
+
+        # split the layers into chunks that each end at a captured layer
+        starts = [0] + [c + 1 for c in self.capture_layers[:-1]]
+        self.chunks = nn.ModuleList([vgg_layers[start:end + 1] for start, end in zip(starts, self.capture_layers)])
 
         for param in self.parameters():
             param.requires_grad = False
-        self.capture_layers = [1, 3, 6, 8, 11, 13, 15, 22, 29]
         self.space = space
+        self.register_buffer('vgg_mean', torch.tensor([0.485, 0.456, 0.406]).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('vgg_std', torch.tensor([0.229, 0.224, 0.225]).view(1, -1, 1, 1), persistent=False)
 
     def forward_base(self, x):
         feat = [x]
-        for i in range(len(self.vgg_layers)):
-            x = self.vgg_layers[i](x)
-            if i in self.capture_layers: feat.append(x)
+        for chunk in self.chunks:
+            x = chunk(x)
+            feat.append(x)
         return feat
 
     def forward(self, x):
         if self.space != 'vgg':
             x = (x + 1.) / 2.
-            x = x - (torch.Tensor([0.485, 0.456, 0.406]).to(x.device).view(1, -1, 1, 1))
-            x = x / (torch.Tensor([0.229, 0.224, 0.225]).to(x.device).view(1, -1, 1, 1))
+            x = (x - self.vgg_mean) / self.vgg_std
         feat = self.forward_base(x)
         return feat
 
     def forward_samples_hypercolumn(self, X, samps=100):
         feat = self.forward(X)
 
-        xx, xy = np.meshgrid(np.arange(X.shape[2]), np.arange(X.shape[3]))
-        xx = np.expand_dims(xx.flatten(), 1)
-        xy = np.expand_dims(xy.flatten(), 1)
-        xc = np.concatenate([xx, xy], 1)
-
-        samples = min(samps, xc.shape[0])
-
-        np.random.shuffle(xc)
-        xx = xc[:samples, 0]
-        yy = xc[:samples, 1]
+        # random pixels without replacement, as (row, column) indices on the device
+        samples = min(samps, X.shape[2] * X.shape[3])
+        perm = torch.randperm(X.shape[2] * X.shape[3], device=X.device)[:samples]
+        xx = perm // X.shape[3]
+        yy = perm % X.shape[3]
 
         feat_samples = []
         for i in range(len(feat)):
@@ -62,14 +62,13 @@ class Vgg16_Extractor(nn.Module):
 
             # hack to detect lower resolution
             if i > 0 and feat[i].size(2) < feat[i - 1].size(2):
-                xx = xx / 2.0
-                yy = yy / 2.0
+                xx = xx // 2
+                yy = yy // 2
 
-            xx = np.clip(xx, 0, layer_feat.shape[2] - 1).astype(np.int32)
-            yy = np.clip(yy, 0, layer_feat.shape[3] - 1).astype(np.int32)
+            xx = xx.clamp(0, layer_feat.shape[2] - 1)
+            yy = yy.clamp(0, layer_feat.shape[3] - 1)
 
-            features = layer_feat[:, :, xx[range(samples)], yy[range(samples)]]
-            feat_samples.append(features.clone().detach())
+            feat_samples.append(layer_feat[:, :, xx, yy])
 
         feat = torch.cat(feat_samples, 1)
         return feat
@@ -121,7 +120,9 @@ def tensor_to_np(tensor, cut_dim_to_3=True):
 def np_to_tensor(npy, space):
     if space == 'vgg':
         return np_to_tensor_correct(npy)
-    return (torch.Tensor(npy.astype(np.float64) / 127.5) - 1.0).permute((2, 0, 1)).unsqueeze(0)
+    # out of place, from_numpy shares memory with the caller's array when it already is float32
+    tensor = torch.from_numpy(np.ascontiguousarray(npy)).to(torch.float32) / 127.5 - 1.0
+    return tensor.permute((2, 0, 1)).unsqueeze(0).contiguous()
 
 
 def np_to_tensor_correct(npy):
@@ -143,8 +144,10 @@ def make_laplace_pyramid(x, levels):
     pyramid = []
     current = x
     for i in range(levels):
-        pyramid.append(laplacian(current))
-        current = tensor_resample(current, (max(current.shape[2] // 2, 1), max(current.shape[3] // 2, 1)))
+        # the downsampled level is both part of the residual and the next input
+        down = tensor_resample(current, (max(current.shape[2] // 2, 1), max(current.shape[3] // 2, 1)))
+        pyramid.append(current - tensor_resample(down, [current.shape[2], current.shape[3]]))
+        current = down
     pyramid.append(current)
     return pyramid
 
@@ -153,7 +156,8 @@ def fold_laplace_pyramid(pyramid):
     current = pyramid[-1]
     for i in range(len(pyramid) - 2, -1, -1):  # iterate from len-2 to 0
         up_h, up_w = pyramid[i].shape[2], pyramid[i].shape[3]
-        current = pyramid[i] + tensor_resample(current, (up_h, up_w))
+        # accumulate into the freshly upsampled tensor, interpolate does not need its output for backward
+        current = tensor_resample(current, (up_h, up_w)).add_(pyramid[i])
     return current
 
 
@@ -167,56 +171,46 @@ def sample_indices(feat_content, feat_style):
     offset_x = np.random.randint(stride_x)
     stride_y = int(max(math.ceil(math.sqrt(big_size // const)), 1))
     offset_y = np.random.randint(stride_y)
-    xx, xy = np.meshgrid(np.arange(feat_content.shape[2])[offset_x::stride_x],
-                         np.arange(feat_content.shape[3])[offset_y::stride_y])
+    device = feat_content.device
+    xx, xy = torch.meshgrid(torch.arange(feat_content.shape[2], device=device)[offset_x::stride_x],
+                            torch.arange(feat_content.shape[3], device=device)[offset_y::stride_y], indexing='xy')
 
     xx = xx.flatten()
     xy = xy.flatten()
     return xx, xy
 
 
-def spatial_feature_extract(feat_result, feat_content, xx, xy):
-    l2, l3 = [], []
-    device = feat_result[0].device
-
-    # for each extracted layer
-    for i in range(len(feat_result)):
-        fr = feat_result[i]
-        fc = feat_content[i]
+def sample_grids(feat, xx, xy):
+    # precompute the normalized bilinear sampling grid of every extracted layer,
+    # grids is (layers, N, 2) with (x=width, y=height) in [-1, 1], coords is (2, N)
+    xx = xx.float()
+    xy = xy.float()
 
+    grids = []
+    for i in range(len(feat)):
         # hack to detect reduced scale
-        if i > 0 and feat_result[i - 1].size(2) > feat_result[i].size(2):
+        if i > 0 and feat[i - 1].size(2) > feat[i].size(2):
             xx = xx / 2.0
             xy = xy / 2.0
 
-        # go back to ints and get residual
-        xxm = np.floor(xx).astype(np.float32)
-        xxr = xx - xxm
+        grids.append(torch.stack([2. * xy / max(feat[i].size(3) - 1, 1) - 1.,
+                                  2. * xx / max(feat[i].size(2) - 1, 1) - 1.], dim=-1))
 
-        xym = np.floor(xy).astype(np.float32)
-        xyr = xy - xym
+    return torch.stack(grids), torch.stack([xx, xy])
 
-        # do bilinear resample
-        w00 = torch.from_numpy((1. - xxr) * (1. - xyr)).float().view(1, 1, -1, 1).to(device)
-        w01 = torch.from_numpy((1. - xxr) * xyr).float().view(1, 1, -1, 1).to(device)
-        w10 = torch.from_numpy(xxr * (1. - xyr)).float().view(1, 1, -1, 1).to(device)
-        w11 = torch.from_numpy(xxr * xyr).float().view(1, 1, -1, 1).to(device)
 
-        xxm = np.clip(xxm.astype(np.int32), 0, fr.size(2) - 1)
-        xym = np.clip(xym.astype(np.int32), 0, fr.size(3) - 1)
-
-        s00 = xxm * fr.size(3) + xym
-        s01 = xxm * fr.size(3) + np.clip(xym + 1, 0, fr.size(3) - 1)
-        s10 = np.clip(xxm + 1, 0, fr.size(2) - 1) * fr.size(3) + (xym)
-        s11 = np.clip(xxm + 1, 0, fr.size(2) - 1) * fr.size(3) + np.clip(xym + 1, 0, fr.size(3) - 1)
+def spatial_feature_extract(feat_result, feat_content, grids, coords):
+    l2, l3 = [], []
 
-        fr = fr.view(1, fr.size(1), fr.size(2) * fr.size(3), 1)
-        fr = fr[:, :, s00, :].mul_(w00).add_(fr[:, :, s01, :].mul_(w01)).add_(fr[:, :, s10, :].mul_(w10)).add_(
-            fr[:, :, s11, :].mul_(w11))
+    # for each extracted layer
+    for i in range(len(feat_result)):
+        grid = grids[i].view(1, 1, -1, 2)
 
-        fc = fc.view(1, fc.size(1), fc.size(2) * fc.size(3), 1)
-        fc = fc[:, :, s00, :].mul_(w00).add_(fc[:, :, s01, :].mul_(w01)).add_(fc[:, :, s10, :].mul_(w10)).add_(
-            fc[:, :, s11, :].mul_(w11))
+        # bilinear resample
+        fr = F.grid_sample(feat_result[i], grid, mode='bilinear', padding_mode='border',
+                           align_corners=True).transpose(2, 3)
+        fc = F.grid_sample(feat_content[i], grid, mode='bilinear', padding_mode='border',
+                           align_corners=True).transpose(2, 3)
 
         l2.append(fr)
         l3.append(fc)
@@ -224,8 +218,8 @@ def spatial_feature_extract(feat_result, feat_content, xx, xy):
     x_st = torch.cat([li.contiguous() for li in l2], 1)
     c_st = torch.cat([li.contiguous() for li in l3], 1)
 
-    xx = torch.from_numpy(xx).view(1, 1, x_st.size(2), 1).float().to(device)
-    yy = torch.from_numpy(xy).view(1, 1, x_st.size(2), 1).float().to(device)
+    xx = coords[0].view(1, 1, x_st.size(2), 1)
+    yy = coords[1].view(1, 1, x_st.size(2), 1)
 
     x_st = torch.cat([x_st, xx, yy], 1)
     c_st = torch.cat([c_st, xx, yy], 1)
@@ -233,29 +227,47 @@ def spatial_feature_extract(feat_result, feat_content, xx, xy):
 
 
 def pairwise_distances_cos(x, y):
-    x_norm = torch.sqrt((x ** 2).sum(1).view(-1, 1))
-    y_t = torch.transpose(y, 0, 1)
-    y_norm = torch.sqrt((y ** 2).sum(1).view(1, -1))
-    dist = 1. - torch.mm(x, y_t) / x_norm / y_norm
+    x_n = x * (x ** 2).sum(1, keepdim=True).rsqrt()
+    y_n = y * (y ** 2).sum(1, keepdim=True).rsqrt()
+    dist = 1. - torch.mm(x_n, y_n.t())
     return dist
 
 
-def pairwise_distances_sq_l2(x, y):
-    x_norm = (x ** 2).sum(1).view(-1, 1)
-    y_t = torch.transpose(y, 0, 1)
-    y_norm = (y ** 2).sum(1).view(1, -1)
-    dist = x_norm + y_norm - 2.0 * torch.mm(x, y_t)
-    return torch.clamp(dist, 1e-5, 1e5) / x.size(1)
+def pairwise_distances_l2(x, y):
+    # sqrt(clamp(|x - y|^2, 1e-5, 1e5) / d), cdist stays in fp32 under autocast
+    dist = torch.cdist(x.unsqueeze(0), y.unsqueeze(0), p=2).squeeze(0)
+    return torch.clamp(dist, math.sqrt(1e-5), math.sqrt(1e5)) / math.sqrt(x.size(1))
+
+
+def pairwise_distances_cos_l2(x, y):
+    # cosine and l2 distances sharing one mm, in fp32 even under autocast
+    # since the norm expansion of l2 cancels badly in bf16 for near-identical rows
+    with torch.autocast(device_type=x.device.type, enabled=False):
+        dtype = torch.promote_types(x.dtype, torch.float32)  # at least fp32, keeps fp64 as is
+        x, y = x.to(dtype), y.to(dtype)
+        xy = torch.mm(x, y.t())
+        x_norm = (x ** 2).sum(1, keepdim=True)
+        y_norm = (y ** 2).sum(1, keepdim=True).t()
+        cos = 1. - xy * x_norm.rsqrt() * y_norm.rsqrt()
+        l2 = torch.sqrt(torch.clamp(x_norm + y_norm - 2.0 * xy, 1e-5, 1e5) / x.size(1))
+    return cos, l2
 
 
 def distmat(x, y, cos_d=True):
     if cos_d:
         M = pairwise_distances_cos(x, y)
     else:
-        M = torch.sqrt(pairwise_distances_sq_l2(x, y))
+        M = pairwise_distances_l2(x, y)
     return M
 
 
+def distmat_cos_l2(x, y):
+    # distmat(x, y, cos_d=True) + distmat(x, y, cos_d=False)
+    cos, l2 = pairwise_distances_cos_l2(x, y)
+    return cos + l2
+
+
+@torch.compile(dynamic=False)
 def content_loss(feat_result, feat_content):
     d = feat_result.size(1)
 
@@ -278,13 +290,17 @@ def content_loss(feat_result, feat_content):
 
 
 def rgb_to_yuv(rgb):
-    C = torch.Tensor(
-        [[0.577350, 0.577350, 0.577350], [-0.577350, 0.788675, -0.211325], [-0.577350, -0.211325, 0.788675]]).to(
-        rgb.device)
-    yuv = torch.mm(C, rgb)
+    # built directly on the device, and baked into the graph as a constant under torch.compile
+    C = torch.tensor(
+        [[0.577350, 0.577350, 0.577350], [-0.577350, 0.788675, -0.211325], [-0.577350, -0.211325, 0.788675]],
+        device=rgb.device)
+    # keep palette colours in fp32 for the l2 term of style_loss
+    with torch.autocast(device_type=rgb.device.type, enabled=False):
+        yuv = torch.mm(C, rgb.float())
     return yuv
 
 
+@torch.compile(dynamic=False)
 def style_loss(X, Y, cos_d=True):
     d = X.shape[1]
 
@@ -292,26 +308,26 @@ def style_loss(X, Y, cos_d=True):
         X = rgb_to_yuv(X.transpose(0, 1).contiguous().view(d, -1)).transpose(0, 1)
         Y = rgb_to_yuv(Y.transpose(0, 1).contiguous().view(d, -1)).transpose(0, 1)
     else:
-        X = X.transpose(0, 1).contiguous().view(d, -1).transpose(0, 1)
-        Y = Y.transpose(0, 1).contiguous().view(d, -1).transpose(0, 1)
+        # (1, d, N, 1) -> (N, d) as a transposed view, mm and the norms handle the strides
+        X = X.view(d, -1).t()
+        Y = Y.view(d, -1).t()
 
     # Relaxed EMD
-    CX_M = distmat(X, Y, cos_d=True)
-
-    if d == 3: CX_M = CX_M + distmat(X, Y, cos_d=False)
-
-    m1, m1_inds = CX_M.min(1)
-    m2, m2_inds = CX_M.min(0)
+    if d == 3:
+        CX_M = distmat_cos_l2(X, Y)
+    else:
+        CX_M = distmat(X, Y, cos_d=True)
 
-    remd = torch.max(m1.mean(), m2.mean())
+    remd = torch.maximum(CX_M.amin(1).mean(), CX_M.amin(0).mean())
 
     return remd
 
 
+@torch.compile(dynamic=False)
 def moment_loss(X, Y, moments=[1, 2]):
     loss = 0.
-    X = X.squeeze().t()
-    Y = Y.squeeze().t()
+    X = X.view(X.size(1), -1).t()
+    Y = Y.view(Y.size(1), -1).t()
 
     mu_x = torch.mean(X, 0, keepdim=True)
     mu_y = torch.mean(Y, 0, keepdim=True)
@@ -322,10 +338,13 @@ def moment_loss(X, Y, moments=[1, 2]):
         loss = loss + mu_d
 
     if 2 in moments:
-        X_c = X - mu_x
-        Y_c = Y - mu_y
-        X_cov = torch.mm(X_c.t(), X_c) / (X.shape[0] - 1)
-        Y_cov = torch.mm(Y_c.t(), Y_c) / (Y.shape[0] - 1)
+        # cov = (X^T X - N mu^T mu) / (N - 1) in a single addmm, kept in fp32 under autocast
+        # since the uncentered form is prone to cancellation
+        with torch.autocast(device_type=X.device.type, enabled=False):
+            X, Y, mu_x, mu_y = X.float(), Y.float(), mu_x.float(), mu_y.float()
+            n_x, n_y = X.shape[0], Y.shape[0]
+            X_cov = torch.addmm(mu_x.t() @ mu_x, X.t(), X, beta=-n_x / (n_x - 1), alpha=1. / (n_x - 1))
+            Y_cov = torch.addmm(mu_y.t() @ mu_y, Y.t(), Y, beta=-n_y / (n_y - 1), alpha=1. / (n_y - 1))
 
         # print(X_cov.shape)
         # exit(1)
@@ -336,23 +355,27 @@ def moment_loss(X, Y, moments=[1, 2]):
     return loss
 
 
+FEAT_MAX = 3 + 2 * 64 + 128 * 2 + 256 * 3 + 512 * 2  # (sum of all extracted channels)
+
+
 def calculate_loss(feat_result, feat_content, feat_style, indices, content_weight, moment_weight=1.0):
     # spatial feature extract
     num_locations = 1024
-    spatial_result, spatial_content = spatial_feature_extract(feat_result, feat_content, indices[0][:num_locations],
-                                                              indices[1][:num_locations])
+    spatial_result, spatial_content = spatial_feature_extract(feat_result, feat_content,
+                                                              indices[0][:, :num_locations],
+                                                              indices[1][:, :num_locations])
     loss_content = content_loss(spatial_result, spatial_content)
 
     d = feat_style.shape[1]
     spatial_style = feat_style.view(1, d, -1, 1)
-    feat_max = 3 + 2 * 64 + 128 * 2 + 256 * 3 + 512 * 2  # (sum of all extracted channels)
 
-    loss_remd = style_loss(spatial_result[:, :feat_max, :, :], spatial_style[:, :feat_max, :, :])
+    loss_remd = style_loss(spatial_result[:, :FEAT_MAX, :, :], spatial_style[:, :FEAT_MAX, :, :])
 
     loss_moment = moment_loss(spatial_result[:, :-2, :, :], spatial_style, moments=[1, 2])  # -2 is so that it can fit?
-    # palette matching
+    # palette matching, skipped when its weight is negligible
     content_weight_frac = 1. / max(content_weight, 1.)
-    loss_moment += content_weight_frac * style_loss(spatial_result[:, :3, :, :], spatial_style[:, :3, :, :])
+    if content_weight_frac > 1e-3:
+        loss_moment += content_weight_frac * style_loss(spatial_result[:, :3, :, :], spatial_style[:, :3, :, :])
 
     loss_style = loss_remd + moment_weight * loss_moment
     # print(f'Style: {loss_style.item():.3f}, Content: {loss_content.item():.3f}')
@@ -371,40 +394,84 @@ def optimize(result, content, style, scale, content_weight, lr, extractor):
     # if scale == 1:
     #     opt_iter = 800
 
+    # on cuda the iteration is captured once as a cuda graph after a few eager warmup iterations
+    use_graph = result.is_cuda
+    warmup_iter = 3 if use_graph else opt_iter
+
     # use rmsprop
-    optimizer = optim.RMSprop(result_pyramid, lr=lr)
-
-    # extract features for content
-    feat_content = extractor(content)  #
-
-    stylized = fold_laplace_pyramid(result_pyramid)
-    # let's ignore the regions for now
-    # some inner loop that extracts samples
-    feat_style = None
-    for i in range(5):
-        with torch.no_grad():
-            # r is region of interest (mask)
-            feat_e = extractor.forward_samples_hypercolumn(style, samps=1000)
-            feat_style = feat_e if feat_style is None else torch.cat((feat_style, feat_e), dim=2)
-    # feat_style.requires_grad_(False)
+    optimizer = optim.RMSprop(result_pyramid, lr=lr, capturable=use_graph)
+
+    # content and style features are constant for this scale, no autograd needed
+    with torch.inference_mode():
+        # extract features for content
+        feat_content = extractor(content.contiguous(memory_format=torch.channels_last))  #
+
+        # let's ignore the regions for now
+        # some inner loop that extracts samples
+        # r is region of interest (mask)
+        style = style.contiguous(memory_format=torch.channels_last)
+        feat_e = extractor.forward_samples_hypercolumn(style, samps=1000)
+        samps = feat_e.size(2)
+        feat_style = torch.empty(*feat_e.shape[:2], 5 * samps, *feat_e.shape[3:], dtype=feat_e.dtype,
+                                 device=feat_e.device)
+        feat_style[:, :, :samps] = feat_e
+        for i in range(1, 5):
+            feat_style[:, :, i * samps:(i + 1) * samps] = extractor.forward_samples_hypercolumn(style, samps=1000)
+
+    # inference tensors cannot be saved for backward, the style features end up in mm backward
+    # (feat_content is only read by grid_sample without grad and can stay as is)
+    feat_style = feat_style.clone()
 
     # init indices to optimize over
     xx, xy = sample_indices(feat_content[0], feat_style)  # 0 to sample over first layer extracted
-    for it in range(opt_iter):
-        optimizer.zero_grad()
-
-        stylized = fold_laplace_pyramid(result_pyramid)
-        # original code has resample here, seems pointless with uniform shuffle
-        # ...
-        # also shuffle them every y iter
-        if it % 1 == 0 and it != 0:
-            np.random.shuffle(xx)
-            np.random.shuffle(xy)
-        feat_result = extractor(stylized)
-
-        loss = calculate_loss(feat_result, feat_content, feat_style, [xx, xy], content_weight)
+    grids, coords = sample_grids(feat_content, xx, xy)
+
+    def shuffle():
+        # shuffle in place (static addresses for the graph), jointly so that (x, y) pairs stay intact
+        perm = torch.randperm(coords.size(1), device=coords.device)
+        grids.copy_(grids[:, perm])
+        coords.copy_(coords[:, perm])
+
+    def step():
+        # mixed precision forward on cuda only, the pyramid (optimizer params) stays in fp32
+        # (the autocast cache does not work under graph capture)
+        with torch.autocast(device_type=result.device.type, dtype=torch.bfloat16, enabled=result.is_cuda,
+                            cache_enabled=False):
+            stylized = fold_laplace_pyramid(result_pyramid)
+            feat_result = extractor(stylized.contiguous(memory_format=torch.channels_last))
+            loss = calculate_loss(feat_result, feat_content, feat_style, [grids, coords], content_weight)
         loss.backward()
         optimizer.step()
+        return stylized
+
+    # warmup runs on a side stream before capture (no-op stream context on cpu)
+    side_stream = None
+    if use_graph:
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for it in range(warmup_iter):
+            optimizer.zero_grad(set_to_none=True)
+
+            # original code has resample here, seems pointless with uniform shuffle
+            # ...
+            # also shuffle them every y iter
+            if it % 1 == 0 and it != 0:
+                shuffle()
+            stylized = step()
+
+    if use_graph:
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        graph = torch.cuda.CUDAGraph()
+        optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(graph):
+            stylized = step()
+
+        for it in range(warmup_iter, opt_iter):
+            shuffle()
+            graph.replay()
+        stylized = stylized.detach().clone()
     return stylized
 
 
@@ -416,6 +483,8 @@ def strotss(content_pil, style_pil, content_weight=1.0 * 16.0, device='cuda:0',
 
     lr = 2e-3
     extractor = Vgg16_Extractor(space=space).to(device)
+    # NHWC matches the tensor core conv kernels of cuDNN
+    extractor = extractor.to(memory_format=torch.channels_last)
 
     scale_last = max(content_full.shape[2], content_full.shape[3])
     scales = []